@@ -36,7 +36,7 @@ setup(
     python_requires='>=3.7, <4',
     install_requires=[
                       'docopt',
-                      'importlib-metadata'],
+                      'importlib-metadata; python_version < "3.8"'],
     extras_require={
         'dev': ['check-manifest',
                 'flake8',
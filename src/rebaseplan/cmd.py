@@ -38,16 +38,20 @@ Options:
   --reflog-depth=N         How many reflog entries to tag so they show up in the
                            graph [default: 10]
   -f --force               Overwrite current notes with old ones
+  -j --jobs=N              How many git commands to run in parallel, defaults
+                           to twice the number of CPUs, but at most 16
 """
 
+import dataclasses
 import docopt
 import functools
+import sys
+import typing
 
 from .rebaseplan import text_view, gitk_view
 from .rebaseplan import all_branches, no_extra_flags, compose_flags, additional_flags
 from .rebaseplan import rebaseplan, remove_old_tags, propagate_notes, sync_local, sync_remote
 from .rebaseplan import run_command, display_command
-from .rebaseplan import __version__
 
 
 def dense_log(*flags):
@@ -59,10 +63,56 @@ def no_remote_branches(upstream):
         return flags + (f"--decorate-refs-exclude=remotes/{upstream}/*", )
     return filter_upstream
 
+def attribute_name(key):
+    """maps a docopt key like `--max-count` to the Args field `max_count`"""
+    return key.strip("-<>").replace("-", "_") or "separator"
+
+
+@dataclasses.dataclass(frozen=True)
+class Args:
+    """parsed command line, defaults match the usage in the module docstring"""
+    show: bool = False
+    cleanup: bool = False
+    propagate_notes: bool = False
+    sync_local: bool = False
+    sync_remote: bool = False
+    separator: bool = False
+    help: bool = False
+    version: bool = False
+    verbose: bool = False
+    pattern: typing.List[str] = dataclasses.field(default_factory=lambda: ["*/CORE-130*"])
+    all: bool = False
+    max_count: typing.Optional[str] = None
+    view: bool = False
+    main: str = "develop"
+    upstream: str = "origin"
+    show_cmdline: bool = False
+    reflog_depth: str = "10"
+    force: bool = False
+    jobs: typing.Optional[str] = None
+    log_options: typing.List[str] = dataclasses.field(default_factory=list)
+    notes_ref: typing.List[str] = dataclasses.field(default_factory=list)
+
+
+COMMANDS = ("show", "cleanup", "propagate_notes", "sync_local", "sync_remote")
+
+# command lines that need no option parsing at all
+FAST_PATHS = {(): Args(), ("cleanup", ): Args(cleanup=True)}
+
+
+def parse_args(argv):
+    try:
+        return FAST_PATHS[tuple(argv)]
+    except KeyError:
+        pass
+    args = docopt.docopt(__doc__, argv=argv)
+    return Args(**{attribute_name(k): v for k, v in args.items()})
+
+
 def passtrough(args, *flags):
     def read_flags():
         for flag in flags:
-            value = args[flag]
+            value = getattr(args, attribute_name(flag))
             if value is None or isinstance(value, bool):
                 if value:
                     yield flag
@@ -78,58 +128,67 @@ def is_command(k):
 
 
 def main():
-    args = docopt.docopt(__doc__, version=__version__)
+    args = parse_args(sys.argv[1:])
     # print(args)
-    command = [k for k, v in args.items() if k[0] not in "<-" and v]
+    if args.version:
+        from .rebaseplan import __version__
+        print(__version__)
+        return
+    command = [k for k in COMMANDS if getattr(args, k)]
     if not command:
-        args["show"] = True
-    run = run_command if not args["--show-cmdline"] else display_command
-    if args["show"]:
+        args = dataclasses.replace(args, show=True)
+    run = run_command if not args.show_cmdline else display_command
+    jobs = int(args.jobs) if args.jobs else None
+    if args.show:
         rebaseplan(
-            pattern=args["--pattern"],
+            pattern=args.pattern,
             branch_flags=compose_flags(
-                all_branches if args["--all"] else no_extra_flags,
-                additional_flags("--no-merged", args["--main"])
+                all_branches if args.all else no_extra_flags,
+                additional_flags("--no-merged", args.main)
                 ),
-            view=gitk_view if args["--view"] else text_view,
+            view=gitk_view if args.view else text_view,
             optional_log_flags=compose_flags(
-                (no_extra_flags if args["--verbose"] else dense_log),
-                (no_extra_flags if args["--all"]
-                 else no_remote_branches(args["--upstream"])),
-                additional_flags(*args["<log-options>"]),
+                (no_extra_flags if args.verbose else dense_log),
+                (no_extra_flags if args.all
+                 else no_remote_branches(args.upstream)),
+                additional_flags(*args.log_options),
                 passtrough(args, "--max-count"),
             ),
-            main=args["--main"],
-            upstream=args["--upstream"],
+            main=args.main,
+            upstream=args.upstream,
             run=run,
-            reflog_depth=int(args["--reflog-depth"]),
+            reflog_depth=int(args.reflog_depth),
+            jobs=jobs,
         )
-    elif args["cleanup"]:
+    elif args.cleanup:
         remove_old_tags(
             run=run,
         )
-    elif args["propagate-notes"]:
+    elif args.propagate_notes:
         propagate_notes(
-            notes_refs=args["<notes-ref>"],
-            pattern=args["--pattern"],
+            notes_refs=args.notes_ref,
+            pattern=args.pattern,
             branch_flags=no_extra_flags,
-            verbose=args["--verbose"]
+            verbose=args.verbose,
+            jobs=jobs,
         )
-    elif args["sync-local"]:
+    elif args.sync_local:
         sync_local(
-            pattern=args["--pattern"] + [args["--main"]],
-            main=args["--main"],
-            upstream=args["--upstream"],
-            verbose=args["--verbose"],
-            dry_run=not args["--force"]
+            pattern=args.pattern + [args.main],
+            main=args.main,
+            upstream=args.upstream,
+            verbose=args.verbose,
+            dry_run=not args.force,
+            jobs=jobs,
         )
-    elif args["sync-remote"]:
+    elif args.sync_remote:
         sync_remote(
-            pattern=args["--pattern"] + [args["--main"]],
-            main=args["--main"],
-            upstream=args["--upstream"],
-            verbose=args["--verbose"],
-            dry_run=not args["--force"]
+            pattern=args.pattern + [args.main],
+            main=args.main,
+            upstream=args.upstream,
+            verbose=args.verbose,
+            dry_run=not args.force,
+            jobs=jobs,
         )
     else:
         raise Exception(f"Unhandled command '{command}'")
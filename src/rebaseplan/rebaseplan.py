@@ -1,40 +1,114 @@
 import collections
+import collections.abc
+import concurrent.futures
 import contextlib
+import datetime
 import functools
 import itertools
+import os
+import re
 import shlex
+import signal
 import subprocess
 import sys
 import typing
 import enum
 
-import importlib_metadata
 
-
-__version__ = importlib_metadata.version('rebaseplan')
+def __getattr__(name):
+    """looks up `__version__` only when it is asked for"""
+    if name == "__version__":
+        try:
+            import importlib.metadata as importlib_metadata
+        except ImportError:
+            import importlib_metadata
+        version = globals()["__version__"] = importlib_metadata.version('rebaseplan')
+        return version
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def write_indented(stream, output):
+    """writes the captured output to the stream in one go, every line indented"""
+    if isinstance(output, bytes):
+        output = re.sub(rb"(?m)^(?=.)", b"    ", output)
+        if hasattr(stream, "buffer"):
+            # text printed earlier has to come out first
+            stream.flush()
+            stream.buffer.write(output)
+        else:
+            stream.write(output.decode(errors="replace"))
+    else:
+        stream.write(re.sub(r"(?m)^(?=.)", "    ", output))
+    stream.flush()
 
 
 def subprocess_run(args, **kwargs):
-    if kwargs.pop("dry_run", False):
-        print("#  ", format_command(args))
-        return
     try:
         return subprocess.run(args, **kwargs)
     except subprocess.CalledProcessError as cpe:
         print("ERROR: ", format_command(cpe.cmd), file=sys.stderr, flush=True)
         if cpe.stdout is not None:
-            print("", *cpe.stdout.splitlines(), sep="    ", flush=True)
+            write_indented(sys.stdout, cpe.stdout)
         if cpe.stderr is not None:
-            print("", *cpe.stderr.splitlines(), sep="    ", file=sys.stderr, flush=True)
+            write_indented(sys.stderr, cpe.stderr)
         raise
 
 
-def all_branches(*flags):
-    return flags + ("--all", )
+def subprocess_run_dry(args, *, dry_run, **kwargs):
+    """only prints the command when dry_run is set"""
+    if dry_run:
+        print("#  ", format_command(args))
+        return
+    return subprocess_run(args, **kwargs)
+
+
+def default_jobs():
+    """the threads mostly wait for git processes, so use two per CPU"""
+    return min(16, 2 * (os.cpu_count() or 1))
+
+
+def spawn_capture(args):
+    """runs the command and returns its standard output as bytes
+
+    Uses posix_spawn, which is much lighter than subprocess for the many
+    small git queries. The standard error of the command is not captured.
+    """
+    if not hasattr(os, "posix_spawnp"):
+        return subprocess_run(args, capture_output=True, check=True).stdout
+    read_fd, write_fd = os.pipe()
+    with open(read_fd, "rb") as stdout:
+        try:
+            # python ignores these, subprocess restores them for git too
+            pid = os.posix_spawnp(args[0], args, os.environ,
+                                  file_actions=[(os.POSIX_SPAWN_DUP2, write_fd, 1)],
+                                  setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+        finally:
+            os.close(write_fd)
+        output = stdout.read()
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    if returncode:
+        print("ERROR: ", format_command(args), file=sys.stderr, flush=True)
+        raise subprocess.CalledProcessError(returncode, args, output)
+    return output
 
 
-def remote_branches(*flags):
-    return flags + ("--remote", )
+def iter_lines(args, *, text=True):
+    """yields the output lines of the command as they are produced"""
+    newline = "\n" if text else b"\n"
+    with subprocess.Popen(args, stdout=subprocess.PIPE, text=text) as proc:
+        for line in proc.stdout:
+            yield line.rstrip(newline)
+    if proc.returncode:
+        print("ERROR: ", format_command(args), file=sys.stderr, flush=True)
+        raise subprocess.CalledProcessError(proc.returncode, args)
+
+
+def all_branches(*flags):
+    return flags + ("--all", )
 
 
 def no_extra_flags(*flags):
@@ -42,8 +116,10 @@ def no_extra_flags(*flags):
 
 
 def compose_flags(*funcs):
+    """all flag builders only append, so their flags are collected once"""
+    extra = functools.reduce(lambda x, func: func(*x), funcs, ())
     def composer(*flags):
-        return functools.reduce(lambda x, func: func(*x), funcs, flags)
+        return flags + extra
     return composer
 
 
@@ -56,69 +132,108 @@ def additional_flags(*additional):
 def list_branches(*, pattern, branch_flags):
     if isinstance(pattern, str):
         pattern = [pattern]
-    cmd = subprocess_run(
-        ["git", "branch"] + list(branch_flags()) + ["--list"] + pattern,
-        text=True, capture_output=True, check=True)
-    return [b[2:] for b in cmd.stdout.splitlines()]
+    stdout = spawn_capture(
+        ["git", "branch"] + list(branch_flags()) + ["--list"] + pattern)
+    return [b[2:].decode() for b in stdout.split(b"\n") if b]
 
 
-def head_reflog(branch, n):
-    cmd = subprocess_run(
-        ["git", "reflog", "show", branch, "--"],
-        text=True, capture_output=True, check=True)
-    yield branch
-    for ref in cmd.stdout.splitlines()[1:n]:
-        _, ref, _ = ref.split(maxsplit=2)
-        yield ref.rstrip(':')
+def branches_with_reflogs(*, pattern, n, branch_flags):
+    branches = list_branches(pattern=pattern, branch_flags=branch_flags)
+    reflogs = all_reflogs(branches, n)
+    for branch in branches:
+        yield branch
+        for _, reflog_name in reflogs[branch][1:]:
+            yield reflog_name
 
 
-def branches_with_reflogs(*, pattern, n, branch_flags):
-    for branch in list_branches(pattern=pattern, branch_flags=branch_flags):
-        yield from head_reflog(branch, n)
+TAG_PREFIX = "rebase/last/"
 
 
 def remove_old_tags(*, run):
-    cmd = subprocess_run(
-        ["git", "for-each-ref", "refs/tags/rebase/last/",
-         "--format=%(refname:short)"],
-        text=True, capture_output=True, check=True)
-    old_tags = cmd.stdout.splitlines()
-    if not old_tags:
-        return
-    args = ["git", "tag", "-d"] + list(old_tags)
-    run(args, text=True, capture_output=True, check=True)
+    list_args = ["git", "for-each-ref", f"refs/tags/{TAG_PREFIX}",
+                 "--format=delete %(refname) %(objectname)"]
+    with subprocess.Popen(list_args, stdout=subprocess.PIPE) as old_tags:
+        run(["git", "update-ref", "--stdin"], stdin=old_tags.stdout, check=True)
+    if old_tags.returncode:
+        raise subprocess.CalledProcessError(old_tags.returncode, list_args)
 
 
 def merge_base(*refs):
-    cmd = subprocess_run(["git", "merge-base"] + list(refs),
-                         text=True, capture_output=True, check=True)
-    return cmd.stdout.strip()
-
-
-def tag_last_branches(*, pattern, branch_flags, main, reflog_depth):
-    remove_old_tags(run=run_command)
-    branches = list(list_branches(pattern=pattern, branch_flags=branch_flags))
+    if len(refs) == 2:
+        refs = sorted(refs)
+    return cached_merge_base(*refs)
+
+
+@functools.lru_cache(maxsize=None)
+def cached_merge_base(*refs):
+    return spawn_capture(["git", "merge-base"] + list(refs)).strip().decode()
+
+
+def parent_dirs(refname):
+    """yields `a` and `a/b` for `a/b/c`"""
+    for i, c in enumerate(refname):
+        if c == "/":
+            yield refname[:i]
+
+
+def update_refs(updates, deletes=(), *, expected=None):
+    """removes the deleted refnames and points all `(refname, sha)` refs at
+    their commits with a single `git update-ref` transaction, overwriting
+    existing refs like `git tag -f` does
+
+    git cannot delete `x/1` and create `x/1/1` (or the other way around) in
+    one transaction, only such deletes are done in a transaction before.
+
+    expected maps refnames to the sha they are known to point at, a
+    transaction fails when any of them was moved in the meantime"""
+    expected = expected or {}
+    updated = {ref for ref, _ in updates}
+    updated_dirs = {d for ref in updated for d in parent_dirs(ref)}
+    in_the_way = {ref for ref in deletes
+                  if ref in updated_dirs or not updated.isdisjoint(parent_dirs(ref))}
+    deletes = [ref for ref in deletes if ref not in in_the_way]
+    for commands in ([f"delete {ref}\0{expected.get(ref, '')}\0" for ref in in_the_way],
+                     [f"delete {ref}\0{expected.get(ref, '')}\0" for ref in deletes]
+                     + [f"update {ref}\0{sha}\0{expected.get(ref, '')}\0" for ref, sha in updates]):
+        if commands:
+            subprocess_run(["git", "update-ref", "--stdin", "-z"],
+                           input="".join(commands), text=True, check=True)
+
+
+def tag_last_branches(*, pattern, branch_flags, main, reflog_depth, jobs=None):
+    main = sys.intern(main)
+    old_tags = dict(line.split(" ", 1) for line in spawn_capture(
+        ["git", "for-each-ref", f"refs/tags/{TAG_PREFIX}",
+         "--format=%(refname) %(objectname)"]).decode().splitlines())
+    branches = list_branches(pattern=pattern, branch_flags=branch_flags)
     tags = []
-    bases = set()
-    last_bases = set()
+    updates = []
+    last_shas = set()
+    reflogs = all_reflogs(branches, 1+reflog_depth)
     for branch in branches:
-        bases.add(merge_base(branch, main))
-        log = list(head_reflog(branch, 1+reflog_depth))
-        for i, last_sha in enumerate(log[1:], 1):
-            tag = f"rebase/last/{branch}/{i}"
+        for i, (last_sha, _) in enumerate(reflogs[branch][1:], 1):
+            tag = f"{TAG_PREFIX}{branch}/{i}"
             tags.append(tag)
-            subprocess_run(["git", "tag", "-f", tag, last_sha], check=True)
-            last_bases.add(merge_base(tag, main))
+            updates.append((f"refs/tags/{tag}", last_sha))
+            last_shas.add(last_sha)
+
+    with concurrent.futures.ThreadPoolExecutor(jobs or default_jobs()) as executor:
+        bases = executor.map(lambda ref: merge_base(ref, main), branches)
+        last_bases = executor.map(lambda ref: merge_base(ref, main), last_shas)
+        bases, last_bases = set(bases), set(last_bases)
 
     base_tags = []
     for i, base_sha in enumerate(bases):
-        base_tag = f"rebase/last/__base__/{i}"
+        base_tag = f"{TAG_PREFIX}__base__/{i}"
         base_tags.append(base_tag)
-        subprocess_run(["git", "tag", "-f", base_tag, base_sha], check=True)
+        updates.append((f"refs/tags/{base_tag}", base_sha))
     for i, base_sha in enumerate(last_bases - bases):
-        base_tag = f"rebase/last/__last_base__/{i}"
+        base_tag = f"{TAG_PREFIX}__last_base__/{i}"
         base_tags.append(base_tag)
-        subprocess_run(["git", "tag", "-f", base_tag, base_sha], check=True)
+        updates.append((f"refs/tags/{base_tag}", base_sha))
+    updated = {ref for ref, _ in updates}
+    update_refs(updates, deletes=[ref for ref in old_tags if ref not in updated],
+                expected=old_tags)
 
     return branches, tags, base_tags
 
@@ -156,11 +271,13 @@ def rebaseplan(*, pattern,
                main="develop",
                upstream="origin",
                run=run_command,
-               reflog_depth=1):
+               reflog_depth=1,
+               jobs=None):
     branches, tags, base_tags = tag_last_branches(pattern=pattern,
                                                   branch_flags=branch_flags,
                                                   main=main,
-                                                  reflog_depth=reflog_depth)
+                                                  reflog_depth=reflog_depth,
+                                                  jobs=jobs)
     args = (view(optional_log_flags)
             + [f"^{main}^", f"^{main}@{{u}}^"]
             + branches
@@ -169,61 +286,180 @@ def rebaseplan(*, pattern,
     run(args, check=True)
 
 
+@functools.lru_cache(maxsize=None)
+def git_common_dir():
+    return os.fsdecode(spawn_capture(["git", "rev-parse", "--git-common-dir"]).strip())
+
+
+def reflog_file(branch):
+    for prefix in ("refs/heads/", "refs/remotes/", "refs/"):
+        path = os.path.join(git_common_dir(), "logs", prefix + branch)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def reflog_date(timestamp, tz):
+    """formats a reflog timestamp the way `git reflog show --date=iso` does"""
+    sign = -1 if tz[0] == "-" else 1
+    offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5]))
+    date = datetime.datetime.fromtimestamp(int(timestamp),
+                                           datetime.timezone(sign * offset))
+    return f"{date:%Y-%m-%d %H:%M:%S} {tz}"
+
+
+REFLOG_FILE_LINE = re.compile(r"^[0-9a-f]+ ([0-9a-f]+) [^>]*> (\d+) ([-+]\d{4})(?:\t|$)")
+
+
+def read_reflog(branch):
+    """returns the [(full_commit_id, timestamp, tz), ...] entries of the
+    reflog file of the branch, newest first, or None when it has none"""
+    path = reflog_file(branch)
+    if path is None:
+        return None
+    with open(path, encoding="utf-8", errors="surrogateescape") as f:
+        entries = [m.groups() for m in map(REFLOG_FILE_LINE.match, f) if m]
+    entries.reverse()
+    return entries
+
+
+def bulk_reflogs(branches):
+    """returns a map {branch: [(full_commit_id, reflog_name), ...]}
+
+    The reflogs are read directly from the files in the git directory,
+    branches that do not have one there are left out.
+    """
+    reflogs = {}
+    for branch in branches:
+        entries = read_reflog(branch)
+        if entries is None:
+            continue
+        reflogs[branch] = [(commit_id, f"{branch}@{{{reflog_date(timestamp, tz)}}}")
+                           for commit_id, timestamp, tz in entries]
+    return reflogs
+
+
+def all_reflogs(branches, n):
+    """returns a map {branch: [(full_commit_id, reflog_name), ...]} of the n
+    newest reflog entries of every branch, named `branch@{i}`"""
+    reflogs = {}
+    for branch in branches:
+        entries = read_reflog(branch)
+        if entries is not None:
+            commit_ids = [commit_id for commit_id, _, _ in entries[:n]]
+        else:
+            commit_ids = spawn_capture(["git", "reflog", "show", "--format=%H",
+                                        "-n", str(n), branch, "--"]).decode().split()
+        reflogs[branch] = [(commit_id, f"{branch}@{{{i}}}")
+                           for i, commit_id in enumerate(commit_ids)]
+    return reflogs
+
+
 ReflogEntry = collections.namedtuple("ReflogEntry", "commit_id, reflog_name, current_branch, i")
 class branch_reflog:
-    def __init__(self, branch):
-        cmd = subprocess_run(
-            ["git", "reflog", "show", "--date=iso", "--pretty=format:%H %gd", branch],
-            text=True, capture_output=True, check=True)
+    def __init__(self, branch, reflog=None):
+        """reflog is a sequence of (full_commit_id, reflog_name), newest
+        first, as returned by bulk_reflogs, git is asked when missing"""
+        if reflog is None:
+            lines = iter_lines(["git", "reflog", "show", "--date=iso",
+                                "--pretty=format:%H %gd", branch], text=False)
+            fields = (line.partition(b" ") for line in lines if line)
+            reflog = ((commit_id.decode("ascii"), reflog_name.decode())
+                      for commit_id, _, reflog_name in fields)
         self.branch = branch
-        self.reflog = tuple(ReflogEntry(*ref.split(maxsplit=1), not i, i) for i, ref in enumerate(cmd.stdout.splitlines()))
+        self.reflog = tuple(ReflogEntry(*ref, not i, i) for i, ref in enumerate(reflog))
+        self.index = {entry.commit_id: entry.i for entry in reversed(self.reflog)}
+        self.commit_ids = frozenset(self.index)
 
     def latest_of(self, commit_ids):
-        """returns a (full_commit_id, reflog_name, current_branch_flag)"""
+        """returns a (full_commit_id, reflog_name, current_branch_flag)
+
+        commit_ids is a single commit id or any collection of them"""
+        if isinstance(commit_ids, str):
+            commit_ids = (commit_ids, )
+        if not isinstance(commit_ids, (collections.abc.Set, collections.abc.Mapping)):
+            commit_ids = frozenset(commit_ids)
+        if len(commit_ids) < len(self.index):
+            latest = min((self.index[commit_id] for commit_id in commit_ids
+                          if commit_id in self.index), default=None)
+            return None if latest is None else self.reflog[latest]
         for entry in self.reflog:
             if entry.commit_id in commit_ids:
                 return entry
         return None
 
-    @property
-    def commit_ids(self):
-        return tuple(entry.commit_id for entry in self.reflog)
-
 
 def notes_map(notes_ref):
     """returns a map {full_commit_id: notes_id}"""
-    cmd = subprocess_run(
-        ["git", "notes", "--ref", notes_ref, "list"],
-        text=True, capture_output=True, check=True)
-    return dict(note.split()[::-1] for note in cmd.stdout.splitlines())
-
-
-def add_note(*, notes_ref, commit_id, message=None, note=None, force=False):
-    if isinstance(message, str):
-        message = [message]
-    elif message is None:
-        message=[]
-    else:
-        pass
-    if note is None:
-        note = []
-    else:
-        note = [note]
-
-    args = (["git", "notes", "--ref", notes_ref, "add"]
-            + ["-f"] * bool(force)
-            + [f"-m{m}" for m in message]
-            + [f"-C{c}" for c in note]
-            + [commit_id])
-    subprocess_run(args, check=True)
-
-
-def propagate_notes(*, notes_refs, pattern, branch_flags, verbose=False, force=False):
-    reflogs = list(map(branch_reflog,
-                       list_branches(pattern=pattern,
-                                     branch_flags=branch_flags)))
-    for notes_ref in notes_refs:
-        notes = notes_map(notes_ref)
+    notes = {}
+    for line in iter_lines(["git", "notes", "--ref", notes_ref, "list"], text=False):
+        notes_id, _, commit_id = line.partition(b" ")
+        notes[commit_id.decode("ascii")] = notes_id.decode("ascii")
+    return notes
+
+
+def expand_notes_ref(notes_ref):
+    """returns the full refname `git notes --ref` uses for notes_ref"""
+    if notes_ref.startswith("refs/notes/"):
+        return notes_ref
+    if notes_ref.startswith("notes/"):
+        return f"refs/{notes_ref}"
+    return f"refs/notes/{notes_ref}"
+
+
+def read_blobs(blob_ids):
+    """returns a map {blob_id: content} read with a single `git cat-file`"""
+    blob_ids = list(dict.fromkeys(blob_ids))
+    stdout = subprocess_run(["git", "cat-file", "--batch"],
+                            input="".join(f"{blob_id}\n" for blob_id in blob_ids).encode(),
+                            capture_output=True, check=True).stdout
+    blobs = {}
+    start = 0
+    for blob_id in blob_ids:
+        header_end = stdout.index(b"\n", start)
+        size = int(stdout[start:header_end].rsplit(b" ", 1)[1])
+        blobs[blob_id] = stdout[header_end + 1:header_end + 1 + size]
+        start = header_end + 1 + size + 1
+    return blobs
+
+
+def write_notes(*, notes_ref, notes):
+    """writes the {commit_id: content} notes with a single `git fast-import`
+
+    They all go into one commit on top of the notes ref, replacing notes the
+    commits already have, like `git notes add -f` does."""
+    if not notes:
+        return
+    notes_ref = expand_notes_ref(notes_ref)
+    tip = subprocess_run(["git", "rev-parse", "-q", "--verify", notes_ref],
+                         capture_output=True).stdout.strip()
+    committer = spawn_capture(["git", "var", "GIT_COMMITTER_IDENT"]).strip()
+    message = b"Notes added by 'rebaseplan propagate-notes'\n"
+    stream = [b"commit %s\n" % notes_ref.encode(),
+              b"committer %s\n" % committer,
+              b"data %d\n%s" % (len(message), message)]
+    if tip:
+        stream.append(b"from %s\n" % tip)
+    for commit_id, content in notes.items():
+        stream.append(b"N inline %s\ndata %d\n%s\n" % (commit_id.encode(), len(content), content))
+    subprocess_run(["git", "fast-import", "--quiet"], input=b"".join(stream), check=True)
+
+
+def propagate_notes(*, notes_refs, pattern, branch_flags, verbose=False, force=False, jobs=None):
+    with concurrent.futures.ThreadPoolExecutor(jobs or default_jobs()) as executor:
+        notes_maps = executor.map(notes_map, notes_refs)
+        branches = list_branches(pattern=pattern, branch_flags=branch_flags)
+        known_reflogs = bulk_reflogs(branches)
+        reflogs = list(executor.map(
+            lambda branch: branch_reflog(branch, known_reflogs.get(branch)),
+            branches))
+        notes_by_ref = dict(zip(notes_refs, notes_maps))
+    if not branches:
+        return
+    tips = dict(zip(branches, spawn_capture(["git", "rev-parse", *branches, "--"])
+                    .decode().splitlines()))
+    for notes_ref, notes in notes_by_ref.items():
+        copies = []
         for reflog in reflogs:
             found = reflog.latest_of(notes)
             if found is None:
@@ -234,27 +470,53 @@ def propagate_notes(*, notes_refs, pattern, branch_flags, verbose=False, force=F
                 continue
             if verbose:
                 print(f"Note {notes_ref} for {reflog.branch} copied from {found.reflog_name}")
-            add_note(notes_ref=notes_ref,
-                     force=force,
-                     message=f"# {found.reflog_name} {found.commit_id}",
-                     note=notes[found.commit_id],
-                     commit_id=reflog.branch)
-
+            copies.append((found, tips[reflog.branch]))
+        if not copies:
+            continue
+        # every note keeps a header saying where it was copied from
+        blobs = read_blobs(notes[found.commit_id] for found, _ in copies)
+        write_notes(notes_ref=notes_ref, notes={
+            commit_id: (f"# {found.reflog_name} {found.commit_id}\n\n".encode()
+                        + blobs[notes[found.commit_id]])
+            for found, commit_id in copies})
+
+
+class GitRefCache:
+    """Tips of all local and remote-tracking branches
+
+    Each kind is listed with a `git for-each-ref` on its first use, so the
+    local branches can be listed before a fetch has updated the remotes.
+    """
+
+    def __init__(self):
+        self._tips = {}
+
+    def load(self, kind):
+        """lists the tips of the "heads" or "remotes" unless already known"""
+        if kind not in self._tips:
+            prefix = f"refs/{kind}/"
+            stdout = spawn_capture(["git", "for-each-ref", prefix,
+                                    "--format=%(objectname) %(refname)"])
+            tips = {}
+            for line in stdout.decode().splitlines():
+                commit_id, refname = line.split(" ", 1)
+                tips[refname[len(prefix):]] = commit_id
+            self._tips[kind] = tips
+        return self._tips[kind]
 
-def ref_sha(ref):
-    cmd = subprocess_run(["git", "rev-parse", ref],
-                         text=True, capture_output=True, check=True)
-    return cmd.stdout.strip()
+    @property
+    def heads(self):
+        """map {local_branch: full_commit_id}"""
+        return self.load("heads")
 
-def branch_exists(branch):
-    return list_branches(pattern=branch,
-                         branch_flags=no_extra_flags)
+    @property
+    def remotes(self):
+        """map {upstream/branch: full_commit_id}"""
+        return self.load("remotes")
 
 
 def get_current_branch():
-    cmd = subprocess_run(["git", "branch", "--show-current"],
-                         text=True, capture_output=True, check=True)
-    return cmd.stdout.strip()
+    return spawn_capture(["git", "branch", "--show-current"]).strip().decode()
 
 
 @contextlib.contextmanager
@@ -263,12 +525,21 @@ def retain_current_branch(*, dry_run):
     yield
     if current != get_current_branch():
         args = (["git", "checkout", current])
-        subprocess_run(args, check=True, dry_run=dry_run)
+        subprocess_run_dry(args, check=True, dry_run=dry_run)
 
 
 def fetch(*, upstream, dry_run):
     args = (["git", "fetch", upstream, "--prune"])
-    subprocess_run(args, check=True, dry_run=dry_run)
+    subprocess_run_dry(args, check=True, dry_run=dry_run)
+
+
+def fetch_loading_heads(*, upstream, dry_run, refs):
+    """fetches and lists the local branches into refs while fetch waits on
+    the network, the remote-tracking branches are left for after it"""
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        fetched = executor.submit(fetch, upstream=upstream, dry_run=dry_run)
+        refs.load("heads")
+        fetched.result()
 
 
 class BranchSyncStatus(enum.IntEnum):
@@ -288,51 +559,104 @@ class BranchSyncState(typing.NamedTuple):
     remote_reflog: ReflogEntry = None
 
 
-def branch_sync_state(*, pattern, main,  upstream):
-    for remote_branch in filter(
-            lambda branch: branch.startswith(f"{upstream}/"),
-            list_branches(pattern=pattern,
-                          branch_flags=compose_flags(
-                              remote_branches,
-                              additional_flags("--no-merged", main)))):
-        local_branch = remote_branch[len(upstream)+1:]
-        state = BranchSyncState(None,
-                local_branch=local_branch,
-                remote_branch=remote_branch)
-
-        if not branch_exists(local_branch):
-            yield state._replace(status=BranchSyncStatus.NEW_LOCAL)
-            continue
-
-        remote_reflog = branch_reflog(remote_branch)
-        local_reflog = branch_reflog(local_branch)
+def is_ancestor(ancestor, descendant):
+    cmd = subprocess_run(["git", "merge-base", "--is-ancestor", ancestor, descendant])
+    if cmd.returncode not in (0, 1):
+        raise subprocess.CalledProcessError(cmd.returncode, cmd.args)
+    return cmd.returncode == 0
+
+
+def classify_branch(*, local_branch, remote_branch, local_tips, remote_tips, reflogs):
+    state = BranchSyncState(None,
+            local_branch=local_branch,
+            remote_branch=remote_branch)
+
+    if local_branch not in local_tips:
+        return state._replace(status=BranchSyncStatus.NEW_LOCAL)
+
+    local_sha = local_tips[local_branch]
+    remote_sha = remote_tips[remote_branch]
+    if local_sha == remote_sha:
+        return state._replace(status=BranchSyncStatus.UPTODATE)
+
+    remote_reflog = branch_reflog(remote_branch, reflogs.get(remote_branch))
+    local_reflog = branch_reflog(local_branch, reflogs.get(local_branch))
+    state = state._replace(
+        remote_reflog=remote_reflog.latest_of({local_sha}),
+        local_reflog=local_reflog.latest_of({remote_sha}))
+
+    if state.remote_reflog is not None and state.remote_reflog.current_branch:
+        return state._replace(status=BranchSyncStatus.UPTODATE)
+    elif state.remote_reflog is not None:
+        return state._replace(status=BranchSyncStatus.REMOTE_MODIFIED)
+    elif state.local_reflog is not None:
+        return state._replace(status=BranchSyncStatus.LOCAL_MODIFIED)
+    elif is_ancestor(local_sha, remote_sha):
+        return state._replace(status=BranchSyncStatus.REMOTE_MODIFIED)
+    elif is_ancestor(remote_sha, local_sha):
+        return state._replace(status=BranchSyncStatus.LOCAL_MODIFIED)
+    else:
         state = state._replace(
-            remote_reflog=remote_reflog.latest_of(ref_sha(local_branch)),
-            local_reflog=local_reflog.latest_of(ref_sha(remote_branch)))
-
-        if state.remote_reflog is not None and state.remote_reflog.current_branch:
-            yield state._replace(status=BranchSyncStatus.UPTODATE)
-        elif state.remote_reflog is not None:
-            yield state._replace(status=BranchSyncStatus.REMOTE_MODIFIED)
-        elif state.local_reflog is not None:
-            yield state._replace(status=BranchSyncStatus.LOCAL_MODIFIED)
-        else:
-            state = state._replace(
-                remote_reflog=remote_reflog.latest_of(local_reflog.commit_ids),
-                local_reflog=local_reflog.latest_of(remote_reflog.commit_ids))
+            remote_reflog=remote_reflog.latest_of(local_reflog.commit_ids),
+            local_reflog=local_reflog.latest_of(remote_reflog.commit_ids))
 
-            if state.remote_reflog is None and state.local_reflog is None:
-                yield state._replace(status=BranchSyncStatus.UNRELATED)
-            else:
-                yield state._replace(status=BranchSyncStatus.CONFLICTED)
+        if state.remote_reflog is None and state.local_reflog is None:
+            return state._replace(status=BranchSyncStatus.UNRELATED)
+        else:
+            return state._replace(status=BranchSyncStatus.CONFLICTED)
 
 
-def sync_local(*, pattern, main,  upstream, verbose=False, dry_run=False):
+def branch_sync_state(*, pattern, main,  upstream, jobs=None, refs=None):
+    if isinstance(pattern, str):
+        pattern = [pattern]
+    # git branch matches the patterns against the short remote names, the
+    # same way the other commands do, and --format leaves out symref arrows
+    stdout = spawn_capture(["git", "branch", "--remote", "--no-merged", main,
+                            "--format=%(refname:lstrip=2)", "--list", *pattern])
+    prefix = f"{upstream}/".encode()
+    if refs is None:
+        refs = GitRefCache()
+    local_tips = refs.heads
+    remote_tips = refs.remotes
+    pairs = [(remote_branch[len(prefix):].decode(), remote_branch.decode())
+             for remote_branch in stdout.split(b"\n")
+             if remote_branch.startswith(prefix)]
+    diverged = [(local_branch, remote_branch)
+                for local_branch, remote_branch in pairs
+                if local_branch in local_tips
+                and local_tips[local_branch] != remote_tips[remote_branch]]
+    # new and up to date branches are told apart by their tips alone
+    for local_branch, remote_branch in set(pairs).difference(diverged):
+        yield classify_branch(local_branch=local_branch,
+                              remote_branch=remote_branch,
+                              local_tips=local_tips,
+                              remote_tips=remote_tips,
+                              reflogs={})
+    if not diverged:
+        return
+    reflogs = bulk_reflogs([branch for pair in diverged for branch in pair])
+    with concurrent.futures.ThreadPoolExecutor(jobs or default_jobs()) as executor:
+        futures = [executor.submit(classify_branch,
+                                   local_branch=local_branch,
+                                   remote_branch=remote_branch,
+                                   local_tips=local_tips,
+                                   remote_tips=remote_tips,
+                                   reflogs=reflogs)
+                   for local_branch, remote_branch in diverged]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+def sync_local(*, pattern, main,  upstream, verbose=False, dry_run=False, jobs=None):
     with retain_current_branch(dry_run=dry_run):
-        fetch(upstream=upstream, dry_run=dry_run)
+        refs = GitRefCache()
+        fetch_loading_heads(upstream=upstream, dry_run=dry_run, refs=refs)
+        states = sorted(branch_sync_state(pattern=pattern, main=main, upstream=upstream, jobs=jobs,
+                                          refs=refs),
+                        key=lambda state: (state.status, state.local_branch))
 
         last_status = None
-        for state in sorted(branch_sync_state(pattern=pattern, main=main, upstream=upstream)):
+        for state in states:
             if last_status != state.status:
                 print()
                 last_status = state.status
@@ -340,14 +664,14 @@ def sync_local(*, pattern, main,  upstream, verbose=False, dry_run=False):
             if state.status == BranchSyncStatus.NEW_LOCAL:
                 print(state.status, state.local_branch, state.remote_branch)
                 args = ["git", "branch", "-q", "--track", state.local_branch, state.remote_branch]
-                subprocess_run(args, check=True, dry_run=dry_run)
+                subprocess_run_dry(args, check=True, dry_run=dry_run)
 
             elif state.status == BranchSyncStatus.REMOTE_MODIFIED:
                 print("Switching", state.status, state.local_branch, "to", state.remote_branch)
                 args = ["git", "checkout", "-q", state.local_branch]
-                subprocess_run(args, check=True, dry_run=dry_run)
+                subprocess_run_dry(args, check=True, dry_run=dry_run)
                 args = ["git", "reset", "-q", "--hard", state.remote_branch]
-                subprocess_run(args, check=True, dry_run=dry_run)
+                subprocess_run_dry(args, check=True, dry_run=dry_run)
 
             elif state.status == BranchSyncStatus.LOCAL_MODIFIED:
                 print(state.status, state.local_branch, "ahead of", state.remote_branch, "=", state.local_reflog)
@@ -355,27 +679,31 @@ def sync_local(*, pattern, main,  upstream, verbose=False, dry_run=False):
             else:
                 print(state.status, state.local_branch, state.remote_branch)
 
-def sync_remote(*, pattern, main,  upstream, verbose=False, dry_run=False):
-        fetch(upstream=upstream, dry_run=dry_run)
-
-        force_pushes = []
-        last_status = None
-        for state in sorted(branch_sync_state(pattern=pattern, main=main, upstream=upstream)):
-            if last_status != state.status:
-                if verbose:
-                    print()
-                last_status = state.status
-
-            if state.status == BranchSyncStatus.LOCAL_MODIFIED:
-                if verbose:
-                    print("Will push", state.local_branch, "ahead of", state.remote_branch, "=", state.local_reflog)
-                force_pushes.append(state.local_branch)
-            else:
-                if verbose or state.status in (BranchSyncStatus.CONFLICTED, BranchSyncStatus.REMOTE_MODIFIED):
-                    print(state.status, state.local_branch, state.remote_branch)
+def sync_remote(*, pattern, main,  upstream, verbose=False, dry_run=False, jobs=None):
+    refs = GitRefCache()
+    fetch_loading_heads(upstream=upstream, dry_run=dry_run, refs=refs)
+    states = sorted(branch_sync_state(pattern=pattern, main=main, upstream=upstream, jobs=jobs,
+                                      refs=refs),
+                    key=lambda state: (state.status, state.local_branch))
+
+    force_pushes = []
+    last_status = None
+    for state in states:
+        if last_status != state.status:
+            if verbose:
+                print()
+            last_status = state.status
 
-        if force_pushes:
-            args = (["git", "push", upstream, "-f"] + force_pushes)
-            subprocess_run(args, check=True, dry_run=dry_run)
+        if state.status == BranchSyncStatus.LOCAL_MODIFIED:
+            if verbose:
+                print("Will push", state.local_branch, "ahead of", state.remote_branch, "=", state.local_reflog)
+            force_pushes.append(state.local_branch)
         else:
-            print("Nothing to do")
+            if verbose or state.status in (BranchSyncStatus.CONFLICTED, BranchSyncStatus.REMOTE_MODIFIED):
+                print(state.status, state.local_branch, state.remote_branch)
+
+    if force_pushes:
+        args = (["git", "push", upstream, "-f"] + force_pushes)
+        subprocess_run_dry(args, check=True, dry_run=dry_run)
+    else:
+        print("Nothing to do")
@@ -0,0 +1,10 @@
+import docopt
+import pytest
+
+from rebaseplan import cmd
+
+
+@pytest.mark.parametrize("argv", sorted(cmd.FAST_PATHS))
+def test_fast_paths_match_docopt(argv):
+    args = docopt.docopt(cmd.__doc__, argv=list(argv))
+    assert cmd.FAST_PATHS[argv] == cmd.Args(**{cmd.attribute_name(k): v for k, v in args.items()})
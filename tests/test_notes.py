@@ -0,0 +1,41 @@
+import pytest
+
+from rebaseplan import rebaseplan
+from test_reflog import git, git_reflog
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """a branch whose note stayed on the commit it was amended from"""
+    for variable in ("GIT_COMMITTER_NAME", "GIT_AUTHOR_NAME"):
+        monkeypatch.setenv(variable, "a")
+    for variable in ("GIT_COMMITTER_EMAIL", "GIT_AUTHOR_EMAIL"):
+        monkeypatch.setenv(variable, "a@example.com")
+    git("init", "-q", "-b", "develop", str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    git("commit", "-q", "--allow-empty", "-m", "base")
+    git("checkout", "-q", "-b", "feat/x")
+    git("commit", "-q", "--allow-empty", "-m", "x1")
+    git("notes", "--ref", "review", "add", "-m", "LGTM", "feat/x")
+    git("commit", "-q", "--allow-empty", "--amend", "-m", "x1 amended")
+    rebaseplan.git_common_dir.cache_clear()
+    yield tmp_path
+    rebaseplan.git_common_dir.cache_clear()
+
+
+def test_propagate_notes_keeps_header(repo):
+    old_commit, reflog_name = git_reflog("feat/x")[1]
+    rebaseplan.propagate_notes(notes_refs=["review"], pattern=["feat/*"],
+                               branch_flags=rebaseplan.no_extra_flags)
+    note = git("notes", "--ref", "review", "show", "feat/x")
+    assert note == f"# {reflog_name} {old_commit}\n\nLGTM\n"
+
+
+def test_propagate_notes_skips_noted_tip(repo):
+    rebaseplan.propagate_notes(notes_refs=["review"], pattern=["feat/*"],
+                               branch_flags=rebaseplan.no_extra_flags)
+    notes = git("log", "--format=%H", "refs/notes/review")
+    rebaseplan.propagate_notes(notes_refs=["review"], pattern=["feat/*"],
+                               branch_flags=rebaseplan.no_extra_flags)
+    assert git("log", "--format=%H", "refs/notes/review") == notes
+
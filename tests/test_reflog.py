@@ -0,0 +1,74 @@
+import os
+import subprocess
+
+import pytest
+
+from rebaseplan import rebaseplan
+
+
+def git(*args, date=None, cwd=None):
+    env = dict(os.environ,
+               GIT_AUTHOR_NAME="a", GIT_AUTHOR_EMAIL="a@example.com",
+               GIT_COMMITTER_NAME="a", GIT_COMMITTER_EMAIL="a@example.com")
+    if date is not None:
+        env.update(GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+    return subprocess.run(["git", *args], cwd=cwd, env=env, check=True,
+                          capture_output=True, text=True).stdout
+
+
+def git_reflog(branch):
+    """the reflog as git itself formats it"""
+    stdout = git("reflog", "show", "--date=iso", "--pretty=format:%H %gd", branch)
+    return [tuple(line.split(" ", 1)) for line in stdout.splitlines()]
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """a clone with a local and a remote-tracking branch, their reflogs are
+    written in timezones east and west of UTC"""
+    upstream = tmp_path / "upstream"
+    git("init", "-q", "-b", "develop", str(upstream))
+    git("commit", "-q", "--allow-empty", "-m", "base",
+        date="2020-01-01 10:00:00 +0000", cwd=upstream)
+    git("checkout", "-q", "-b", "feat/x", cwd=upstream)
+    git("commit", "-q", "--allow-empty", "-m", "x1",
+        date="2020-01-02 23:30:00 -0700", cwd=upstream)
+
+    clone = tmp_path / "clone"
+    git("clone", "-q", str(upstream), str(clone), date="2020-01-03 01:15:00 +0530")
+    monkeypatch.chdir(clone)
+    git("checkout", "-q", "-b", "feat/y", "origin/feat/x",
+        date="2020-01-03 02:00:00 +0530")
+    git("commit", "-q", "--allow-empty", "-m", "y1",
+        date="2020-06-30 23:59:59 -0930")
+    git("commit", "-q", "--allow-empty", "-m", "y2",
+        date="2020-07-01 00:00:00 +1245")
+    # the reflog message ends like an identity line does
+    git("commit", "-q", "--allow-empty", "-m", "compare x> 5 -0100",
+        date="2020-07-02 08:00:00 +0200")
+
+    git("commit", "-q", "--allow-empty", "-m", "x2",
+        date="2020-02-01 12:00:00 -0700", cwd=upstream)
+    git("fetch", "-q", "origin", date="2020-02-01 20:00:00 +0100")
+    git("commit", "-q", "--allow-empty", "-m", "x3",
+        date="2020-02-02 12:00:00 -0700", cwd=upstream)
+    git("fetch", "-q", "origin", date="2020-02-02 20:00:00 -0330")
+
+    rebaseplan.git_common_dir.cache_clear()
+    yield clone
+    rebaseplan.git_common_dir.cache_clear()
+
+
+def test_bulk_reflogs_match_git(repo):
+    branches = ["feat/y", "origin/feat/x"]
+    reflogs = rebaseplan.bulk_reflogs(branches)
+    for branch in branches:
+        assert reflogs[branch] == git_reflog(branch)
+    assert len(reflogs["feat/y"]) == 4
+    assert len(reflogs["origin/feat/x"]) == 2
+
+
+def test_bulk_reflogs_skip_branches_without_reflog(repo):
+    git("update-ref", "--no-deref", "refs/heads/no-log", "HEAD")
+    os.remove(os.path.join(".git", "logs", "refs", "heads", "no-log"))
+    assert "no-log" not in rebaseplan.bulk_reflogs(["no-log"])
@@ -0,0 +1,46 @@
+import pytest
+
+from rebaseplan import rebaseplan
+from test_reflog import git
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    git("init", "-q", "-b", "develop", str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    git("commit", "-q", "--allow-empty", "-m", "base")
+    rebaseplan.git_common_dir.cache_clear()
+    yield tmp_path
+    rebaseplan.git_common_dir.cache_clear()
+
+
+def make_branch(branch):
+    git("checkout", "-q", "-b", branch, "develop")
+    git("commit", "-q", "--allow-empty", "-m", f"{branch} 1")
+    git("commit", "-q", "--allow-empty", "-m", f"{branch} 2")
+    git("checkout", "-q", "develop")
+
+
+def tag_last_branches():
+    return rebaseplan.tag_last_branches(pattern=["*"],
+                                        branch_flags=rebaseplan.no_extra_flags,
+                                        main="develop", reflog_depth=2)
+
+
+def branch_tags():
+    tags = git("for-each-ref", "--format=%(refname)",
+               f"refs/tags/{rebaseplan.TAG_PREFIX}").split()
+    return [tag for tag in tags if "/__" not in tag]
+
+
+@pytest.mark.parametrize("old_branch, new_branch", [("x", "x/1"), ("x/1", "x")])
+def test_tags_of_a_replaced_branch(repo, old_branch, new_branch):
+    make_branch(old_branch)
+    tag_last_branches()
+    assert branch_tags() == [f"refs/tags/rebase/last/{old_branch}/{i}" for i in (1, 2)]
+
+    git("branch", "-q", "-D", old_branch)
+    make_branch(new_branch)
+    _, tags, _ = tag_last_branches()
+    assert tags == [f"rebase/last/{new_branch}/{i}" for i in (1, 2)]
+    assert branch_tags() == [f"refs/tags/{tag}" for tag in tags]